@@ -2,9 +2,11 @@
 # Copyright 2023 OrthoPole. All rights reserved.
 
 
-from typing import TextIO
-from io import StringIO
+from typing import TextIO, BinaryIO, Callable
+from types import CodeType
+from functools import lru_cache
 import sys
+import re
 
 
 VERSION = '2.0.0'
@@ -16,19 +18,19 @@ DESCRIPTION = 'A LaTeX preprocessor'
 # command line parser
 class CommandLineParser:
 
-    class UnknownShortcode(BaseException):
+    class UnknownShortcode(Exception):
         def __init__(self, shortcode: str):
             self.shortcode = shortcode
 
-    class CombinedShortcode(BaseException):
+    class CombinedShortcode(Exception):
         def __init__(self, shortcode: str):
             self.shortcode = shortcode
 
-    class UnknownOption(BaseException):
+    class UnknownOption(Exception):
         def __init__(self, option: str):
             self.option = option
 
-    class RepeatedOption(BaseException):
+    class RepeatedOption(Exception):
         def __init__(self, option: str):
             self.option = option
 
@@ -42,94 +44,128 @@ class CommandLineParser:
     def set_paralength(self, long: str, length: int) -> None:
         self._paralength[long] = length
 
+    # parser states
+    _TOP = 'TOP'
+    _EXPECT_PARA = 'EXPECT_PARA'
+
+    # argument kinds
+    _LONG = 'LONG'
+    _SHORT_GROUP = 'SHORT_GROUP'
+    _VALUE = 'VALUE'
+
+    @classmethod
+    def _classify(cls, arg: str) -> str:
+        if arg.startswith('--'):
+            return cls._LONG
+        if arg.startswith('-'):
+            return cls._SHORT_GROUP
+        return cls._VALUE
+
+    # every action takes the current (state, para, remain) and returns the next one
+
+    def _long(self, d: dict, arg: str, state: str, para: str, remain: int) -> tuple[str, str, int]:
+        option = arg[2:]
+        if option in d:
+            raise self.RepeatedOption(option)
+        d[option] = []
+        if option not in self._paralength:
+            raise self.UnknownOption(option)
+        if self._paralength[option] > 0:
+            return self._EXPECT_PARA, option, self._paralength[option]
+        return state, para, remain
+
+    def _short_group(self, d: dict, arg: str, state: str, para: str, remain: int) -> tuple[str, str, int]:
+        for a in arg[1:]:
+            if a not in self._shortcodes:
+                raise self.UnknownShortcode(a)
+            longcode = self._shortcodes[a]
+            if longcode in d:
+                raise self.RepeatedOption(longcode)
+            d[longcode] = []
+            if longcode in self._paralength and self._paralength[longcode] > 0:
+                if len(arg) != 2:
+                    raise self.CombinedShortcode(a)
+                state, para, remain = self._EXPECT_PARA, longcode, self._paralength[longcode]
+        return state, para, remain
+
+    def _value(self, d: dict, arg: str, state: str, para: str, remain: int) -> tuple[str, str, int]:
+        d[''].append(arg)
+        return state, para, remain
+
+    def _parameter(self, d: dict, arg: str, state: str, para: str, remain: int) -> tuple[str, str, int]:
+        d[para].append(arg)
+        remain -= 1
+        if remain == 0:
+            return self._TOP, para, remain
+        return state, para, remain
+
+    _TABLE = {
+        (_TOP, _LONG): _long,
+        (_TOP, _SHORT_GROUP): _short_group,
+        (_TOP, _VALUE): _value,
+        (_EXPECT_PARA, _LONG): _long,
+        (_EXPECT_PARA, _SHORT_GROUP): _short_group,
+        (_EXPECT_PARA, _VALUE): _parameter
+    }
+
     def parse(self, args: list[str]) -> dict[str, list[str]]:
         d: dict = {'': []}
-        mode: bool = False
+        state: str = self._TOP
         para: str = ''
         remain: int = 0
         for arg in args[1:]:
-            if arg[0] == '-':
-                if arg[1] == '-':
-                    para = arg[2:]
-                    if para in d:
-                        raise self.RepeatedOption(para)
-                    d[para] = []
-                    if para in self._paralength:
-                        mode = True
-                        remain = self._paralength[para]
-                    else:
-                        raise self.UnknownOption(para)
-                else:
-                    for a in arg[1:]:
-                        if a in self._shortcodes:
-                            longcode = self._shortcodes[a]
-                            if longcode in d:
-                                raise self.RepeatedOption(longcode)
-                            d[longcode] = []
-                            if longcode in self._paralength and self._paralength[longcode] > 0:
-                                if len(arg) == 2:
-                                    para = longcode
-                                    mode = True
-                                    remain = self._paralength[para]
-                                else:
-                                    raise self.CombinedShortcode(a)
-                        else:
-                            raise self.UnknownShortcode(a)
-            else:
-                if mode:
-                    d[para].append(arg)
-                    remain -= 1
-                    if remain == 0:
-                        mode = False
-                else:
-                    d[''].append(arg)
+            action = self._TABLE[(state, self._classify(arg))]
+            state, para, remain = action(self, d, arg, state, para, remain)
         return d
 
 
 # matex language compiler
 class MatexCompiler:
 
+    class InvalidExpression(Exception):
+        def __init__(self, expression: str):
+            self.expression = expression
+
     class _Reader:
 
-        def __init__(self, input: TextIO):
-            self._input = input
-            self._seps = [0]
+        __slots__ = ('_data', '_pos', '_start', '_line_no', '_mode')
+
+        # the next line that is neither blank nor a comment, without its
+        # surrounding whitespace
+        _LINE_RE = re.compile(r'^[^\S\n]*([^\s#](?:[^\n]*\S)?)[^\S\n]*$', re.M)
+
+        def __init__(self, data: str):
+            self._data = data
+            self._pos = 0
+            self._start = 0
+            self._line_no = 1
             self._mode = 'matex'
 
         def readline(self):
-            while self._input.readable():
-                line = self._input.readline()
-                if self.tell() > self._seps[-1]:
-                    self._seps.append(self.tell())
-                if line == '':
+            if self._mode == 'matex':
+                m = self._LINE_RE.search(self._data, self._pos)
+                if m is None:
+                    self._pos = len(self._data)
+                    return None
+                self._advance(m.start())
+                self._pos = m.end() + 1
+                head, _, tail = m.group(1).partition(' ')
+                return sys.intern(head.upper()), tail
+            elif self._mode == 'python':
+                if self._pos >= len(self._data):
                     return None
-                if self._mode == 'matex':
-                    if line == '':
-                        return None, None
-                    line = line.strip()
-                    if line == '':
-                        continue
-                    if line[0] == '#':
-                        continue
-                    try:
-                        head, tail = line.split(' ', 1)
-                    except ValueError:
-                        return line.upper(), ''
-                    return head.upper(), tail
-                elif self._mode == 'python':
-                    return line
-
-        def tell(self) -> int:
-            return self._input.tell()
-
-        def seek(self, pos: int):
-            self._input.seek(pos)
+                end = self._data.find('\n', self._pos) + 1 or len(self._data)
+                self._advance(self._pos)
+                self._pos = end
+                return self._data[self._start:end]
+
+        # move to the line starting at `start`, counting the lines passed over
+        def _advance(self, start: int):
+            self._line_no += self._data.count('\n', self._start, start)
+            self._start = start
 
         def line(self) -> int:
-            for i in range(len(self._seps)):
-                if self._seps[i] >= self.tell():
-                    return i
-            return i
+            return self._line_no
 
         def setmode(self, mode: str):
             self._mode = mode
@@ -145,82 +181,145 @@ class MatexCompiler:
 
     class _Executor:
 
+        __slots__ = ('_compiler', '_globals', '_code_cache')
+
         def __init__(self, compiler):
             self._compiler = compiler
             self._globals = {
                 'upperlower': self._upperlower,
                 'echo': self._compiler._print
             }
+            self._code_cache: dict[tuple[str, str], CodeType | SyntaxError] = {}
+
+        def compile(self, code: str, mode: str) -> CodeType | SyntaxError:
+            key = (code, mode)
+            code_obj = self._code_cache.get(key)
+            if code_obj is None:
+                # builtin eval() strips leading spaces and tabs, compile() does not
+                source = code.lstrip(' \t') if mode == 'eval' else code
+                try:
+                    code_obj = compile(source, '<matex>', mode)
+                except SyntaxError as error:
+                    # remember the failure so that it is not compiled again
+                    code_obj = error.with_traceback(None)
+                self._code_cache[key] = code_obj
+            return code_obj
 
         def exec(self, code: str, variables: dict) -> bool:
+            code_obj = self.compile(code, 'exec')
+            if isinstance(code_obj, SyntaxError):
+                return self._compiler._error(f'invalid python code: {code_obj}')
             try:
-                exec(code, self._globals, variables)
-            except:
-                return self._compiler._error(f'invalid python code')
+                exec(code_obj, self._globals, variables)
+            except Exception as error:
+                return self._compiler._error(f'invalid python code: {error}')
             return True
 
-        def eval(self, code: str, variables: dict) -> str:
+        def eval(self, code: str | CodeType | SyntaxError, variables: dict) -> str:
+            code_obj = self.compile(code, 'eval') if isinstance(code, str) else code
+            if isinstance(code_obj, SyntaxError):
+                self._compiler._error(f'invalid python code: {code_obj}')
+                return None
             try:
-                return eval(code, self._globals, variables)
-            except:
-                self._compiler._error(f'invalid python code')
+                return eval(code_obj, self._globals, variables)
+            except Exception as error:
+                self._compiler._error(f'invalid python code: {error}')
                 return None
 
-        @staticmethod
-        def _upperlower(string: str) -> str:
-            result = ''
+        # a lowercase run (spaces do not end it) or a run of anything else;
+        # only valid for ASCII strings
+        _CASE_RUN = re.compile(r'([a-z][a-z ]*)|([^a-z]+)')
+
+        # pure, and often called with the same title inside `FOR` loops
+        @classmethod
+        @lru_cache(maxsize=1024)
+        def _upperlower(cls, string: str) -> str:
+            parts = []
             upper = True
-            for char in string:
-                if char == ' ':
-                    result += char
-                    continue
-                elif char == char.upper() and not upper:
-                    result += r'\normalsize '
-                    upper = True
-                elif char == char.lower() and upper:
-                    result += r'\footnotesize '
-                    upper = False
-                result += char.upper()
-            return result + r'\normalsize '
-
-    _output: StringIO
+            if string.isascii():
+                for lower, other in cls._CASE_RUN.findall(string):
+                    if lower:
+                        if upper:
+                            parts.append(r'\footnotesize ')
+                            upper = False
+                        parts.append(lower.upper())
+                    else:
+                        if not upper:
+                            parts.append(r'\normalsize ')
+                            upper = True
+                        parts.append(other.upper())
+            else:
+                # any character changed by upper() counts as lowercase
+                for char in string:
+                    if char != char.upper():
+                        if upper:
+                            parts.append(r'\footnotesize ')
+                            upper = False
+                    elif not upper and char != ' ':
+                        parts.append(r'\normalsize ')
+                        upper = True
+                    parts.append(char.upper())
+            parts.append(r'\normalsize ')
+            return ''.join(parts)
+
+    _output: list[str]
+    _write: Callable[[str], object]
     _input: _Reader
+    _line: int
     _out_info: TextIO
     _out_error: TextIO
     _out_warning: TextIO
 
     def __init__(self, info: TextIO, error: TextIO, warning: TextIO):
-        self._output = StringIO()
+        self._output = []
+        self._write = self._output.append
         self._out_info = info
         self._out_error = error
         self._out_warning = warning
         self._executor = self._Executor(self)
 
-    def _print(self, *args, **kwargs):
-        print(*args, **kwargs, file=self._output)
+    # same keywords as print(), which echo() exposes to python code; flush is
+    # accepted and ignored, the output is flushed when the target is closed
+    def _print(self, *args, sep: str | None = ' ', end: str | None = '\n', flush: bool = False):
+        if sep is None:
+            sep = ' '
+        if end is None:
+            end = '\n'
+        self._write(sep.join(map(str, args)) + end)
+
+    # fast path of _print() for a single string on its own line
+    def _emit(self, string: str):
+        self._write(string + '\n')
 
     def _info(self, *args, **kwargs):
         print(*args, **kwargs, file=self._out_info)
 
     def _error(self, *args, **kwargs):
-        print(f'error: in line {self._input.line()}: ', end='', file=self._out_error)
+        print(f'error: in line {self._line}: ', end='', file=self._out_error)
         print(*args, **kwargs, file=self._out_error)
         return False
 
     def _warn(self, *args, **kwargs):
-        print(f'warning: in line {self._input.line()}: ', end='', file=self._out_warning)
+        print(f'warning: in line {self._line}: ', end='', file=self._out_warning)
         print(*args, **kwargs, file=self._out_error)
 
-    def finish(self, output: TextIO):
-        self._output.seek(0)
-        content = self._output.read()
-        output.write(content)
-        self._output.close()
-        self._output = StringIO()
-
-    def compile(self, input: TextIO, autocomment: bool = False) -> bool:
-        self._input = self._Reader(input)
+    # only needed when compile() was not given an output to write to
+    def finish(self, output: BinaryIO):
+        output.write(''.join(self._output).encode('utf-8'))
+        self._output.clear()
+
+    # without an output, the result is kept in memory until finish() so that
+    # nothing is written if compilation fails; with one, it is written as it
+    # is produced and a failed compilation leaves partial output behind
+    def compile(self, input: TextIO, autocomment: bool = False, output: BinaryIO | None = None) -> bool:
+        if output is None:
+            self._write = self._output.append
+        else:
+            write = output.write
+            self._write = lambda string: write(string.encode('utf-8'))
+        self._input = self._Reader(input.read())
         head, tail = self._input.readline()
+        self._line = self._input.line()
         if head is None:
             return self._error('version not specified')
         if head != 'VERSION':
@@ -236,420 +335,361 @@ class MatexCompiler:
         else:
             return self._error(f'unknown version {version}')
 
-    def _parse_v1(self, autocomment: bool = False, **kwargs) -> bool:
+    # key words of the tags, matched case-insensitively; the trailing space is
+    # only looked ahead at, so that adjacent key words sharing a space are all
+    # found
+    _CMD_KEYS = re.compile(r' (TO BE|OF|DEFAULT)(?= )', re.I)
+    _ENV_KEYS = re.compile(r' (PRE|POST|OF|DEFAULT)(?= )', re.I)
+    _THM_KEYS = re.compile(r' (COUNTER|NAME|UNDER|STYLE)(?= )', re.I)
+    _DEF_KEY = re.compile(r' TO BE ', re.I)
+    _FOR_KEY = re.compile(r' IN ', re.I)
+
+    # a copy of tail in which key words can be found with str.find(); this is
+    # tail.upper() unless upper-casing changes the length (e.g. `ß`), in which
+    # case only the key words are upper-cased so offsets still index tail
+    @staticmethod
+    def _upper_keys(pattern: re.Pattern, tail: str) -> str:
+        up = tail.upper()
+        if len(up) != len(tail):
+            up = pattern.sub(lambda match: match.group(0).upper(), tail)
+        return up
+
+    def _do_def(self, tail: str) -> bool:
+        match = self._DEF_KEY.search(tail)
+        if match is None:
+            return self._error('`TO BE` key words expected')
+        macro = tail[:match.start()].strip()
+        defin = tail[match.end():].strip()
+        self._emit(r'\def%s{%s}' % (macro, defin))
+        return True
+
+    def _do_cmd(self, tail: str) -> bool:
+        up = self._upper_keys(self._CMD_KEYS, tail)
+        mid1 = up.find(' TO BE ')
+        mid2 = up.find(' OF ')
+        mid3 = up.find(' DEFAULT ')
+        if mid1 < 0:
+            return self._error('`TO BE` key words excepted')
+        command = tail[:mid1].strip()
+        if mid2 >= 0:
+            definition = tail[mid1+7:mid2].strip()
+            length = tail[mid2+4:mid3].strip()
+        else:
+            definition = tail[mid1+7:].strip()
+            length = 0
+        if mid3 >= 0:
+            if length == 0:
+                return self._error('cannot set default value for a command without parameters')
+            default = tail[mid3+9:]
+        else:
+            default = None
+        try:
+            length = int(length)
+        except ValueError:
+            return self._error(f'parameter length should be an integer (got "{length}" instead)')
+        if length < 0:
+            return self._error(f'parameter length should be non-negative (got {length} instead)')
+        if default is None:
+            self._emit(r'\newcommand{%s}[%d]{%s}' % (command, length, definition))
+        else:
+            self._emit(r'\newcommand{%s}[%d][%s]{%s}' % (command, length, default, definition))
+        return True
+
+    def _do_pac(self, tail: str) -> bool:
+        mid = tail.find(' OPTION ')
+        if mid < 0:
+            package = tail.strip()
+            option = None
+        else:
+            package = tail[:mid].strip()
+            option = tail[mid+8:].strip()
+        if option is None:
+            self._emit(r'\usepackage{%s}' % package)
+        else:
+            self._emit(r'\usepackage[%s]{%s}' % (option, package))
+        return True
+
+    def _do_env(self, tail: str) -> bool:
+        up = self._upper_keys(self._ENV_KEYS, tail)
+        mid1 = up.find(' PRE ')
+        mid2 = up.find(' POST ')
+        mid3 = up.find(' OF ')
+        mid4 = up.find(' DEFAULT ')
+        if mid1 < 0:
+            return self._error('`PRE` key word expected')
+        if mid2 < 0:
+            return self._error('`POST` key word expected')
+        environment = tail[:mid1].strip()
+        pre = tail[mid1+5:mid2].strip()
+        if mid3 < 0 and mid4 < 0:
+            post = tail[mid2+6:].strip()
+            length = 0
+            default = None
+        elif mid3 >= 0 and mid4 < 0:
+            post = tail[mid2+6:mid3].strip()
+            length = tail[mid2+6:mid3].strip()
+            default = None
+        elif mid3 < 0 and mid4 >= 0:
+            return self._error('cannot set default value for an environment without parameters')
+        else:
+            post = tail[mid2+6:mid3].strip()
+            length = tail[mid3+4:mid4].strip()
+            default = tail[mid4+8:].strip()
+        try:
+            length = int(length)
+        except ValueError:
+            return self._error(f'parameter length should be an integer (got "{length}" instead)')
+        if length < 0:
+            return self._error(f'parameter length should be non-negative (got {length} instead)')
+        if default is None:
+            self._emit(r'\newenvironment{%s}[%d]{%s}{%s}' % (environment, length, pre, post))
+        else:
+            self._emit(r'\newenvironment{%s}[%d][%s]{%s}{%s}' % (environment, length, default, pre, post))
+        return True
+
+    def _do_thm(self, tail: str) -> bool:
+        up = self._upper_keys(self._THM_KEYS, tail)
+        mid1 = up.find(' COUNTER ')
+        mid2 = up.find(' NAME ')
+        mid3 = up.find(' UNDER ')
+        mid4 = up.find(' STYLE ')
+        if mid2 < 0:
+            return self._error('`NAME` key word expected')
+        if mid1 < 0:
+            theorem = tail[:mid2].strip()
+            counter = None
+        else:
+            theorem = tail[:mid1].strip()
+            counter = tail[mid1+9:mid2].strip()
+        if mid3 < 0 and mid4 < 0:
+            name = tail[mid2+5:].strip()
+            under = None
+            style = None
+        elif mid3 >= 0 and mid4 < 0:
+            name = tail[mid2+5:mid3].strip()
+            under = tail[mid3+6:].strip()
+            style = None
+        elif mid3 < 0 and mid4 >= 0:
+            name = tail[mid2+5:mid4].strip()
+            under = None
+            style = tail[mid4+7:].strip()
+        else:
+            name = tail[mid2+5:mid3].strip()
+            under = tail[mid3+6:mid4].strip()
+            style = tail[mid4+7:].strip()
+        if style is None:
+            self._print(r'\theoremstyle{plain}', end='')
+        else:
+            self._print(r'\theoremstyle{%s}' % style, end='')
+        if counter is None and under is None:
+            self._emit(r'\newtheorem{%s}{%s}' % (theorem, name))
+        elif counter is None and under is not None:
+            self._emit(r'\newtheorem{%s}{%s}[%s]' % (theorem, name, under))
+        elif counter is not None and under is None:
+            self._emit(r'\newtheorem{%s}[%s]{%s}' % (theorem, counter, name))
+        else:
+            self._emit(r'\newtheorem{%s}[%s]{%s}[%s]' % (theorem, counter, name, under))
+        return True
+
+    def _do_raw(self, tail: str) -> bool:
+        self._emit(tail.strip())
+        return True
+
+    def _do_com(self, tail: str) -> bool:
+        self._print('%', tail)
+        return True
+
+    # tag ids; the handlers of the tags below `_FOR` are indexed by their id
+    _DEF, _CMD, _PAC, _ENV, _THM, _RAW, _COM, _FOR, _END, _PYTHON = range(10)
+
+    _HANDLERS = (_do_def, _do_cmd, _do_pac, _do_env, _do_thm, _do_raw, _do_com)
+
+    # tags are interned by the reader, so lookups compare by identity
+    _TAG_ID = {
+        sys.intern('DEF'): _DEF,
+        sys.intern('CMD'): _CMD,
+        sys.intern('PAC'): _PAC,
+        sys.intern('ENV'): _ENV,
+        sys.intern('THM'): _THM,
+        sys.intern('RAW'): _RAW,
+        sys.intern('COM'): _COM,
+        sys.intern('FOR'): _FOR,
+        sys.intern('END'): _END,
+        sys.intern('<?PYTHON'): _PYTHON
+    }
+
+    def _parse_v1(self, autocomment: bool = False) -> bool:
 
         if autocomment:
             self._print(f'% This file is automatically generated by MaTeX version {VERSION}.',
                         'Do not edit it manually.', sep=' ', end='\n\n')
 
-        for head, tail in self._input:
-
-            class UnmatchedBraces(BaseException):
-                def __init__(self, index: int):
-                    self.index = index
-
-            class InvalidExpression(BaseException):
-                def __init__(self, expression: str):
-                    self.expression = expression
-
-            def variable_replace(string: str, **kwargs) -> str | None:
-                result = ''
-                i = 0
-                while i < len(string):
-                    if string[i] == '%':
-                        for j in range(i+1, len(string)):
-                            if string[j] == '%':
-                                break
-                        if j == len(string):
-                            raise UnmatchedBraces(i)
-                        try:
-                            result += str(self._executor.eval(string[i+1:j], kwargs))
-                        except Exception:
-                            raise InvalidExpression(string[i+1:j])
-                        i = j + 1
-                    else:
-                        result += string[i]
-                        i += 1
-                return result
+        block = self._read_block()
+        if block is None:
+            return False
+        return self._emit_block_v1(block, {})
 
-            try:
-                tail = variable_replace(tail, **kwargs)
-            except UnmatchedBraces as error:
-                return self._error(f'unmatched `%` at column {error.index}')
-            except InvalidExpression as error:
-                return self._error(f'invalid expression `{error.expression}`')
+    def _parse_v2(self, autocomment: bool = False) -> bool:
 
-            if head == 'DEF':
-                mid = tail.upper().find(' TO BE ')
-                if mid < 0:
-                    return self._error('`TO BE` key words expected')
-                macro = tail[:mid].strip()
-                defin = tail[mid + 7:].strip()
-                self._print(r'\def%s{%s}' % (macro, defin))
-
-            elif head == 'CMD':
-                mid1 = tail.upper().find(' TO BE ')
-                mid2 = tail.upper().find(' OF ')
-                mid3 = tail.upper().find(' DEFAULT ')
-                if mid1 < 0:
-                    return self._error('`TO BE` key words excepted')
-                command = tail[:mid1].strip()
-                if mid2 >= 0:
-                    definition = tail[mid1+7:mid2].strip()
-                    length = tail[mid2+4:mid3].strip()
-                else:
-                    definition = tail[mid1+7:].strip()
-                    length = 0
-                if mid3 >= 0:
-                    if length == 0:
-                        return self._error('cannot set default value for a command without parameters')
-                    default = tail[mid3+9:]
-                else:
-                    default = None
-                try:
-                    length = int(length)
-                except ValueError:
-                    return self._error(f'parameter length should be an integer (got "{length}" instead)')
-                if length < 0:
-                    return self._error(f'parameter length should be non-negative (got {length} instead)')
-                if default is None:
-                    self._print(r'\newcommand{%s}[%d]{%s}' % (command, length, definition))
-                else:
-                    self._print(r'\newcommand{%s}[%d][%s]{%s}' % (command, length, default, definition))
+        if autocomment:
+            self._print(f'% This file is automatically generated by MaTeX version {VERSION}.',
+                        'Do not edit it manually.', sep=' ', end='\n\n')
 
-            elif head == 'PAC':
-                mid = tail.find(' OPTION ')
-                if mid < 0:
-                    package = tail.strip()
-                    option = None
-                else:
-                    package = tail[:mid].strip()
-                    option = tail[mid+8:].strip()
-                if option is None:
-                    self._print(r'\usepackage{%s}' % package)
-                else:
-                    self._print(r'\usepackage[%s]{%s}' % (option, package))
-
-            elif head == 'ENV':
-                mid1 = tail.upper().find(' PRE ')
-                mid2 = tail.upper().find(' POST ')
-                mid3 = tail.upper().find(' OF ')
-                mid4 = tail.upper().find(' DEFAULT ')
-                if mid1 < 0:
-                    return self._error('`PRE` key word expected')
-                if mid2 < 0:
-                    return self._error('`POST` key word expected')
-                environment = tail[:mid1].strip()
-                pre = tail[mid1+5:mid2].strip()
-                if mid3 < 0 and mid4 < 0:
-                    post = tail[mid2+6:].strip()
-                    length = 0
-                    default = None
-                elif mid3 >= 0 and mid4 < 0:
-                    post = tail[mid2+6:mid3].strip()
-                    length = tail[mid2+6:mid3].strip()
-                    default = None
-                elif mid3 < 0 and mid4 >= 0:
-                    return self._error('cannot set default value for an environment without parameters')
-                else:
-                    post = tail[mid2+6:mid3].strip()
-                    length = tail[mid3+4:mid4].strip()
-                    default = tail[mid4+8:].strip()
-                try:
-                    length = int(length)
-                except ValueError:
-                    return self._error(f'parameter length should be an integer (got "{length}" instead)')
-                if length < 0:
-                    return self._error(f'parameter length should be non-negative (got {length} instead)')
-                if default is None:
-                    self._print(r'\newenvironment{%s}[%d]{%s}{%s}' % (environment, length, pre, post))
-                else:
-                    self._print(r'\newenvironment{%s}[%d][%s]{%s}{%s}' % (environment, length, default, pre, post))
-
-            elif head == 'THM':
-                mid1 = tail.upper().find(' COUNTER ')
-                mid2 = tail.upper().find(' NAME ')
-                mid3 = tail.upper().find(' UNDER ')
-                mid4 = tail.upper().find(' STYLE ')
-                if mid2 < 0:
-                    return self._error('`NAME` key word expected')
-                if mid1 < 0:
-                    theorem = tail[:mid2].strip()
-                    counter = None
-                else:
-                    theorem = tail[:mid1].strip()
-                    counter = tail[mid1+9:mid2].strip()
-                if mid3 < 0 and mid4 < 0:
-                    name = tail[mid2+5:].strip()
-                    under = None
-                    style = None
-                elif mid3 >= 0 and mid4 < 0:
-                    name = tail[mid2+5:mid3].strip()
-                    under = tail[mid3+6:].strip()
-                    style = None
-                elif mid3 < 0 and mid4 >= 0:
-                    name = tail[mid2+5:mid4].strip()
-                    under = None
-                    style = tail[mid4+7:].strip()
-                else:
-                    name = tail[mid2+5:mid3].strip()
-                    under = tail[mid3+6:mid4].strip()
-                    style = tail[mid4+7:].strip()
-                if style is None:
-                    self._print(r'\theoremstyle{plain}', end='')
-                else:
-                    self._print(r'\theoremstyle{%s}' % style, end='')
-                if counter is None and under is None:
-                    self._print(r'\newtheorem{%s}{%s}' % (theorem, name))
-                elif counter is None and under is not None:
-                    self._print(r'\newtheorem{%s}{%s}[%s]' % (theorem, name, under))
-                elif counter is not None and under is None:
-                    self._print(r'\newtheorem{%s}[%s]{%s}' % (theorem, counter, name))
-                else:
-                    self._print(r'\newtheorem{%s}[%s]{%s}[%s]' % (theorem, counter, name, under))
+        block = self._read_block(python=True)
+        if block is None:
+            return False
+        return self._emit_block_v2(block, {})
+
+    # split a tail into literal strings and (expression, code) pairs for the
+    # `%...%` parts, so that expressions are compiled only once
+    def _compile_template(self, tail: str) -> list[str | tuple] | None:
+        template = []
+        i = 0
+        while True:
+            j = tail.find('%', i)
+            if j < 0:
+                template.append(tail[i:])
+                break
+            template.append(tail[i:j])
+            k = tail.find('%', j+1)
+            if k < 0:
+                self._error(f'unmatched `%` at column {j}')
+                return None
+            expression = tail[j+1:k]
+            template.append((expression, self._executor.compile(expression, 'eval')))
+            i = k + 1
+        return template
+
+    # read statements up to the matching `END` (or the end of file) as
+    # (line, head, tag, template, body) entries, where tag is the id of head
+    # (None if unknown) and body is the nested block of a `FOR` or the code of
+    # a multi-line python block
+    def _read_block(self, python: bool = False) -> list[tuple] | None:
+        block = []
+        for head, tail in self._input:
+            self._line = line = self._input.line()
+            tag = self._TAG_ID.get(head)
+            template = self._compile_template(tail)
+            if template is None:
+                return None
+            if tag == self._FOR:
+                body = self._read_block(python)
+                if body is None:
+                    return None
+                block.append((line, head, tag, template, body))
+            elif tag == self._END:
+                break
+            elif python and tag == self._PYTHON and tail == '':
+                self._input.setmode('python')
+                code = ''
+                for code_line in self._input:
+                    if code_line.strip() == '?>':
+                        break
+                    code += code_line
+                self._input.setmode('matex')
+                block.append((line, head, tag, template, code))
+            else:
+                block.append((line, head, tag, template, None))
+        return block
+
+    # fill in the `%...%` parts of a template; failed expressions become `None`
+    def _replace_v1(self, template: list, variables: dict) -> str:
+        parts = []
+        for segment in template:
+            if isinstance(segment, str):
+                parts.append(segment)
+                continue
+            expression, code = segment
+            try:
+                parts.append(str(self._executor.eval(code, variables)))
+            except Exception:
+                raise self.InvalidExpression(expression)
+        return ''.join(parts)
+
+    # fill in the `%...%` parts of a template; failed expressions are errors
+    def _replace_v2(self, template: list, variables: dict) -> str:
+        parts = []
+        for segment in template:
+            if isinstance(segment, str):
+                parts.append(segment)
+                continue
+            expression, code = segment
+            e = self._executor.eval(code, variables)
+            if e is None:
+                raise self.InvalidExpression(expression)
+            parts.append(str(e))
+        return ''.join(parts)
+
+    def _emit_block_v1(self, block: list[tuple], kwargs: dict) -> bool:
+
+        for line, head, tag, template, body in block:
+
+            self._line = line
 
-            elif head == 'RAW':
-                self._print(tail.strip())
+            try:
+                tail = self._replace_v1(template, kwargs)
+            except self.InvalidExpression as error:
+                return self._error(f'invalid expression `{error.expression}`')
 
-            elif head == 'COM':
-                self._print('%', tail)
+            if tag is not None and tag < self._FOR:
+                if not self._HANDLERS[tag](self, tail):
+                    return False
 
-            elif head == 'FOR':
-                mid = tail.upper().find(' IN ')
-                if mid < 0:
+            elif tag == self._FOR:
+                match = self._FOR_KEY.search(tail)
+                if match is None:
                     return self._error('`IN` key word expected')
-                variable = tail[:mid].strip()
-                values = tail[mid+4:].strip()
-                loop_start = self._input.tell()
+                variable = tail[:match.start()].strip()
+                values = tail[match.end():].strip()
                 for value in values:
-                    self._input.seek(loop_start)
                     kwargs[variable] = value
-                    if not self._parse_v1(**kwargs):
+                    if not self._emit_block_v1(body, dict(kwargs)):
                         return False
 
-            elif head == 'END':
-                return True
-
             else:
                 return self._error(f'unexpected tag `{head}`')
 
         return True
 
-    def _parse_v2(self, autocomment: bool = False, **kwargs) -> bool:
+    def _emit_block_v2(self, block: list[tuple], kwargs: dict) -> bool:
 
-        if autocomment:
-            self._print(f'% This file is automatically generated by MaTeX version {VERSION}.',
-                        'Do not edit it manually.', sep=' ', end='\n\n')
+        for line, head, tag, template, body in block:
 
-        for head, tail in self._input:
-
-            class UnmatchedBraces(BaseException):
-                def __init__(self, index: int):
-                    self.index = index
-
-            class InvalidExpression(BaseException):
-                def __init__(self, expression: str):
-                    self.expression = expression
-
-            def variable_replace(string: str, **kwargs) -> str | None:
-                result = ''
-                i = 0
-                while i < len(string):
-                    if string[i] == '%':
-                        for j in range(i+1, len(string)):
-                            if string[j] == '%':
-                                break
-                        if j == len(string):
-                            raise UnmatchedBraces(i)
-                        e = self._executor.eval(string[i+1:j], kwargs)
-                        if e is None:
-                            raise InvalidExpression(string[i+1:j])
-                        result += str(e)
-                        i = j + 1
-                    else:
-                        result += string[i]
-                        i += 1
-                return result
+            self._line = line
 
             try:
-                tail = variable_replace(tail, **kwargs)
-            except UnmatchedBraces as error:
-                return self._error(f'unmatched `%` at column {error.index}')
-            except InvalidExpression as error:
+                tail = self._replace_v2(template, kwargs)
+            except self.InvalidExpression as error:
                 return self._error(f'invalid expression `{error.expression}`')
 
-            match head:
-
-                case 'DEF':
-                    mid = tail.upper().find(' TO BE ')
-                    if mid < 0:
-                        return self._error('`TO BE` key words expected')
-                    macro = tail[:mid].strip()
-                    defin = tail[mid + 7:].strip()
-                    self._print(r'\def%s{%s}' % (macro, defin))
-
-                case 'CMD':
-                    mid1 = tail.upper().find(' TO BE ')
-                    mid2 = tail.upper().find(' OF ')
-                    mid3 = tail.upper().find(' DEFAULT ')
-                    if mid1 < 0:
-                        return self._error('`TO BE` key words excepted')
-                    command = tail[:mid1].strip()
-                    if mid2 >= 0:
-                        definition = tail[mid1+7:mid2].strip()
-                        length = tail[mid2+4:mid3].strip()
-                    else:
-                        definition = tail[mid1+7:].strip()
-                        length = 0
-                    if mid3 >= 0:
-                        if length == 0:
-                            return self._error('cannot set default value for a command without parameters')
-                        default = tail[mid3+9:]
-                    else:
-                        default = None
-                    try:
-                        length = int(length)
-                    except ValueError:
-                        return self._error(f'parameter length should be an integer (got "{length}" instead)')
-                    if length < 0:
-                        return self._error(f'parameter length should be non-negative (got {length} instead)')
-                    if default is None:
-                        self._print(r'\newcommand{%s}[%d]{%s}' % (command, length, definition))
-                    else:
-                        self._print(r'\newcommand{%s}[%d][%s]{%s}' % (command, length, default, definition))
+            if tag is not None and tag < self._FOR:
+                if not self._HANDLERS[tag](self, tail):
+                    return False
 
-                case 'PAC':
-                    mid = tail.find(' OPTION ')
-                    if mid < 0:
-                        package = tail.strip()
-                        option = None
-                    else:
-                        package = tail[:mid].strip()
-                        option = tail[mid+8:].strip()
-                    if option is None:
-                        self._print(r'\usepackage{%s}' % package)
-                    else:
-                        self._print(r'\usepackage[%s]{%s}' % (option, package))
-
-                case 'ENV':
-                    mid1 = tail.upper().find(' PRE ')
-                    mid2 = tail.upper().find(' POST ')
-                    mid3 = tail.upper().find(' OF ')
-                    mid4 = tail.upper().find(' DEFAULT ')
-                    if mid1 < 0:
-                        return self._error('`PRE` key word expected')
-                    if mid2 < 0:
-                        return self._error('`POST` key word expected')
-                    environment = tail[:mid1].strip()
-                    pre = tail[mid1+5:mid2].strip()
-                    if mid3 < 0 and mid4 < 0:
-                        post = tail[mid2+6:].strip()
-                        length = 0
-                        default = None
-                    elif mid3 >= 0 and mid4 < 0:
-                        post = tail[mid2+6:mid3].strip()
-                        length = tail[mid2+6:mid3].strip()
-                        default = None
-                    elif mid3 < 0 and mid4 >= 0:
-                        return self._error('cannot set default value for an environment without parameters')
-                    else:
-                        post = tail[mid2+6:mid3].strip()
-                        length = tail[mid3+4:mid4].strip()
-                        default = tail[mid4+8:].strip()
-                    try:
-                        length = int(length)
-                    except ValueError:
-                        return self._error(f'parameter length should be an integer (got "{length}" instead)')
-                    if length < 0:
-                        return self._error(f'parameter length should be non-negative (got {length} instead)')
-                    if default is None:
-                        self._print(r'\newenvironment{%s}[%d]{%s}{%s}' % (environment, length, pre, post))
-                    else:
-                        self._print(r'\newenvironment{%s}[%d][%s]{%s}{%s}' % (environment, length, default, pre, post))
-
-                case 'THM':
-                    mid1 = tail.upper().find(' COUNTER ')
-                    mid2 = tail.upper().find(' NAME ')
-                    mid3 = tail.upper().find(' UNDER ')
-                    mid4 = tail.upper().find(' STYLE ')
-                    if mid2 < 0:
-                        return self._error('`NAME` key word expected')
-                    if mid1 < 0:
-                        theorem = tail[:mid2].strip()
-                        counter = None
-                    else:
-                        theorem = tail[:mid1].strip()
-                        counter = tail[mid1+9:mid2].strip()
-                    if mid3 < 0 and mid4 < 0:
-                        name = tail[mid2+5:].strip()
-                        under = None
-                        style = None
-                    elif mid3 >= 0 and mid4 < 0:
-                        name = tail[mid2+5:mid3].strip()
-                        under = tail[mid3+6:].strip()
-                        style = None
-                    elif mid3 < 0 and mid4 >= 0:
-                        name = tail[mid2+5:mid4].strip()
-                        under = None
-                        style = tail[mid4+7:].strip()
-                    else:
-                        name = tail[mid2+5:mid3].strip()
-                        under = tail[mid3+6:mid4].strip()
-                        style = tail[mid4+7:].strip()
-                    if style is None:
-                        self._print(r'\theoremstyle{plain}', end='')
-                    else:
-                        self._print(r'\theoremstyle{%s}' % style, end='')
-                    if counter is None and under is None:
-                        self._print(r'\newtheorem{%s}{%s}' % (theorem, name))
-                    elif counter is None and under is not None:
-                        self._print(r'\newtheorem{%s}{%s}[%s]' % (theorem, name, under))
-                    elif counter is not None and under is None:
-                        self._print(r'\newtheorem{%s}[%s]{%s}' % (theorem, counter, name))
-                    else:
-                        self._print(r'\newtheorem{%s}[%s]{%s}[%s]' % (theorem, counter, name, under))
-
-                case 'RAW':
-                    self._print(tail.strip())
-
-                case 'COM':
-                    self._print('%', tail)
-
-                case 'FOR':
-                    mid = tail.upper().find(' IN ')
-                    if mid < 0:
-                        return self._error('`IN` key word expected')
-                    variable = tail[:mid].strip()
-                    values = tail[mid+4:].strip()
-                    loop_start = self._input.tell()
-                    for value in values:
-                        self._input.seek(loop_start)
-                        kwargs[variable] = value
-                        if not self._parse_v2(**kwargs):
-                            return False
-
-                case 'END':
-                    return True
-
-                case '<?PYTHON':
-                    self._input.setmode('python')
-                    if tail == '':
-                        code = ''
-                        for line in self._input:
-                            if line.strip() == '?>':
-                                break
-                            code += line
-                    elif tail[-2:] == '?>':
-                        code = tail[:-2]
-                    else:
-                        self._warn(f'`?>` expected at the end of a single-line python code')
-                        code = tail
-                    if not self._executor.exec(code, kwargs):
+            elif tag == self._FOR:
+                match = self._FOR_KEY.search(tail)
+                if match is None:
+                    return self._error('`IN` key word expected')
+                variable = tail[:match.start()].strip()
+                values = tail[match.end():].strip()
+                for value in values:
+                    kwargs[variable] = value
+                    if not self._emit_block_v2(body, dict(kwargs)):
                         return False
-                    self._input.setmode('matex')
 
-                case unexpected_tag:
-                    return self._error(f'unexpected tag "{unexpected_tag}"')
+            elif tag == self._PYTHON:
+                if body is not None:
+                    code = body
+                elif tail[-2:] == '?>':
+                    code = tail[:-2]
+                else:
+                    self._warn(f'`?>` expected at the end of a single-line python code')
+                    code = tail
+                if not self._executor.exec(code, kwargs):
+                    return False
+
+            else:
+                return self._error(f'unexpected tag "{head}"')
 
         return True
 
@@ -704,8 +744,9 @@ if __name__ == '__main__':
         autocomment = False
 
     try:
-        source = open(source, 'r')
-        target = open(target, 'w')
+        # read as UTF-8 to match the encoding the output is written in
+        source = open(source, 'r', encoding='utf-8')
+        target = open(target, 'wb', buffering=1 << 20)
     except FileNotFoundError:
         print(f'error: file "{source}" not found')
         sys.exit(-1)
@@ -714,8 +755,23 @@ if __name__ == '__main__':
         sys.exit(-1)
 
     compiler = MatexCompiler(sys.stdout, sys.stderr, sys.stderr)
-    if compiler.compile(source, autocomment):
-        compiler.finish(target)
+    if target.seekable():
+        # stream into the target, but never leave a half-written target
+        # behind, even if compilation crashes
+        succeeded = False
+        try:
+            succeeded = compiler.compile(source, autocomment, target)
+        finally:
+            if not succeeded:
+                try:
+                    target.seek(0)
+                    target.truncate()
+                except OSError:
+                    pass
+    else:
+        # pipes and terminals cannot be rewound, so only write on success
+        if compiler.compile(source, autocomment):
+            compiler.finish(target)
 
     source.close()
     target.close()